@@ -3,16 +3,29 @@ APLICACIÓN DE CHAT POR SALAS CON FLASK Y WEBSOCKETS
 - Autenticación de usuarios
 - Salas creadas con códigos numéricos de 6 dígitos
 - Mensajes en tiempo real con Socket.IO
-- Carga de archivos (audio, video, imágenes) en Base de Datos
+- Carga de archivos (audio, video, imágenes) en disco, referenciados desde la BD
 """
 
+# El monkey-patch de gevent debe correr antes de cualquier otro import
+# para que socket/ssl/threading queden parcheados de forma cooperativa
+import gevent.monkey
+gevent.monkey.patch_all()
+
 import os
 import hashlib
+import hmac
+import re
 import secrets
+import tempfile
+import time
 from datetime import datetime
 from functools import wraps
 
-from flask import Flask, render_template, request, redirect, session, url_for, flash, jsonify, Response
+import bcrypt
+import orjson
+from mysql.connector.errors import IntegrityError
+
+from flask import Flask, render_template, request, redirect, session, url_for, flash, Response, send_from_directory
 from flask_socketio import SocketIO, join_room, emit
 
 from db import cerrar_db, consultar_db, obtener_db
@@ -20,12 +33,114 @@ from db import cerrar_db, consultar_db, obtener_db
 # ========== CONFIGURACIÓN ==========
 app = Flask(__name__)
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "dev-secret")
+# Propagar excepciones al servidor WSGI en vez de armar la página de debug
+app.config["PROPAGATE_EXCEPTIONS"] = True
 app.config["MAX_CONTENT_LENGTH"] = 20 * 1024 * 1024  # 20MB max para upload
-socketio = SocketIO(app, async_mode="eventlet")
+app.config["MEDIA_ROOT"] = os.environ.get("MEDIA_ROOT", os.path.join(app.root_path, "media"))
+os.makedirs(app.config["MEDIA_ROOT"], exist_ok=True)
+
+class JsonSocketIO:
+    """Adaptador para que Socket.IO serialice con orjson (extensión en C, ~5x
+    más rápido que el json de la stdlib); cada broadcast se codifica una sola
+    vez por sala gracias al fanout por rooms"""
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode("utf-8")
+
+    @staticmethod
+    def loads(dato, *args, **kwargs):
+        return orjson.loads(dato)
+
+# Con REDIS_URL definido, los emit se enrutan por Redis pub/sub y un solo
+# emit llega a los sockets de todos los workers de gunicorn (cada worker
+# escribe solo a su subconjunto). Sin definir, queda en un solo proceso.
+REDIS_URL = os.environ.get("REDIS_URL")
+socketio = SocketIO(
+    app,
+    async_mode="gevent",
+    json=JsonSocketIO,
+    message_queue=REDIS_URL,
+)
+
+# Multi-worker implica que los caches en memoria de este proceso no pueden
+# invalidarse desde los demás workers (un join/leave/delete atendido en otro
+# worker dejaría datos viejos acá), así que en ese modo se desactivan
+MODO_MULTIWORKER = REDIS_URL is not None
 app.teardown_appcontext(cerrar_db)
 
-# Extensiones de archivo permitidas
-ALLOWED_EXTENSIONS = {"mp3", "mp4", "jpg", "png"}
+# Extensiones permitidas y su clasificación, precomputadas para resolver
+# tipo y MIME con un splitext y un lookup (sin cadenas de if/elif)
+EXT_TO_TYPE = {"mp3": "audio", "mp4": "video", "jpg": "image", "png": "image"}
+MIME_POR_EXTENSION = {
+    "mp3": "audio/mpeg",
+    "mp4": "video/mp4",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+}
+
+# Validación de parámetros en rutas calientes: regex precompiladas (corren
+# en C) en lugar de combinar len() e isdigit() en Python
+CODIGO_RE = re.compile(r"^\d{6}\Z")
+ID_RE = re.compile(r"^\d{1,10}\Z")
+
+# ========== RESPUESTAS JSON ==========
+def ojsonify(payload, status=200):
+    """
+    Arma una respuesta JSON con orjson en lugar del encoder de Flask:
+    codifica directo a bytes UTF-8 y maneja datetime nativamente
+    (OPT_NAIVE_UTC marca los utcnow de la BD como UTC).
+    """
+    return Response(
+        orjson.dumps(payload, option=orjson.OPT_NAIVE_UTC),
+        status=status,
+        mimetype="application/json",
+    )
+
+# ========== CACHE EN MEMORIA ==========
+class CacheTTL:
+    """
+    Cache en memoria con expiración por entrada.
+    Evita repetir consultas a la BD en rutas calientes (reconexiones, etc).
+    Con activo=False se comporta como cache siempre vacío (modo multi-worker,
+    donde la invalidación local no alcanza a los otros procesos).
+    """
+    def __init__(self, ttl, max_entradas=10000, activo=True):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self.activo = activo
+        self._datos = {}
+
+    def obtener(self, clave):
+        """Retorna el valor cacheado o None si no existe o ya expiró"""
+        if not self.activo:
+            return None
+        entrada = self._datos.get(clave)
+        if entrada is None:
+            return None
+        valor, expira = entrada
+        if time.monotonic() > expira:
+            self._datos.pop(clave, None)
+            return None
+        return valor
+
+    def guardar(self, clave, valor):
+        """Guarda un valor; si el cache está lleno se vacía por completo"""
+        if not self.activo:
+            return
+        if len(self._datos) >= self.max_entradas:
+            self._datos.clear()
+        self._datos[clave] = (valor, time.monotonic() + self.ttl)
+
+    def invalidar(self, clave):
+        """Elimina una entrada (por ejemplo al cambiar membresías)"""
+        self._datos.pop(clave, None)
+
+# Salas de un usuario, para no golpear la BD en tormentas de reconexión
+cache_salas_usuario = CacheTTL(ttl=30, activo=not MODO_MULTIWORKER)
+
+# Membresía (id_usuario, id_sala) -> bool, consultada en cada mensaje
+cache_membresia = CacheTTL(ttl=60, activo=not MODO_MULTIWORKER)
 
 # ========== DECORADORES ==========
 def requiere_login(fn):
@@ -38,29 +153,40 @@ def requiere_login(fn):
     return wrapper
 
 # ========== FUNCIONES DE SEGURIDAD ==========
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", "12"))
+
 def hashear_contrasena(contrasena):
     """
-    Hashea una contraseña con salt usando SHA256
+    Hashea una contraseña con bcrypt (KDF lento, salt embebido en el hash)
     @param contrasena: Contraseña en texto plano
-    @return: String con formato "salt$hash"
+    @return: String con el hash bcrypt ("$2b$...")
     """
-    salt = secrets.token_hex(16)
-    digest = hashlib.sha256((salt + contrasena).encode("utf-8")).hexdigest()
-    return f"{salt}${digest}"
+    digest = bcrypt.hashpw(contrasena.encode("utf-8"), bcrypt.gensalt(rounds=BCRYPT_ROUNDS))
+    return digest.decode("utf-8")
+
+def es_hash_legado(almacenada):
+    """Detecta hashes del formato viejo "salt$sha256" (sin prefijo bcrypt)"""
+    return not almacenada.startswith("$2")
 
 def verificar_contrasena(contrasena, almacenada):
     """
-    Verifica si una contraseña coincide con su hash almacenado
+    Verifica si una contraseña coincide con su hash almacenado.
+    Soporta bcrypt y el formato viejo "salt$sha256" (migración perezosa).
     @param contrasena: Contraseña en texto plano
-    @param almacenada: Hash almacenado en formato "salt$hash"
+    @param almacenada: Hash almacenado (bcrypt o "salt$hash")
     @return: True si coincide, False si no
     """
-    try:
-        salt, digest = almacenada.split("$", 1)
-    except ValueError:
-        return False
-    check = hashlib.sha256((salt + contrasena).encode("utf-8")).hexdigest()
-    return check == digest
+    if es_hash_legado(almacenada):
+        try:
+            salt, digest = almacenada.split("$", 1)
+        except ValueError:
+            return False
+        check = hashlib.sha256((salt + contrasena).encode("utf-8")).hexdigest()
+        # Comparación en tiempo constante para no filtrar el prefijo del hash
+        return hmac.compare_digest(check, digest)
+    if isinstance(almacenada, str):
+        almacenada = almacenada.encode("utf-8")
+    return bcrypt.checkpw(contrasena.encode("utf-8"), almacenada)
 
 # ========== FUNCIONES DE SALAS Y USUARIOS ==========
 def nombre_sala(tipo_sala, id_sala):
@@ -71,38 +197,36 @@ def nombre_sala_usuario(id_usuario):
     """Genera un nombre único para la sala personal del usuario"""
     return f"user_{id_usuario}"
 
-CODIGO_ALFABETO = "0123456789"
-
 def generar_codigo_sala():
     """
-    Genera un código numérico único de 6 dígitos para la sala
+    Genera un código numérico de 6 dígitos para la sala.
+    La unicidad la garantiza el UNIQUE KEY sobre Salas.codigo: el llamador
+    reintenta el INSERT con un código nuevo si este choca.
     @return: String de 6 números
     """
-    while True:
-        codigo = "".join(secrets.choice(CODIGO_ALFABETO) for _ in range(6))
-        existe = consultar_db(
-            "SELECT id_sala FROM Salas WHERE codigo = %s",
-            (codigo,),
-            one=True,
-        )
-        if not existe:
-            return codigo
+    # Una sola llamada al CSPRNG y un solo formateo, en vez de 6 choice + join
+    return f"{secrets.randbelow(1_000_000):06d}"
 
 def usuario_en_sala(id_usuario, id_sala):
-    """Verifica si un usuario es miembro de una sala"""
-    fila = consultar_db(
-        """
-        SELECT id FROM Miembros_Sala
-        WHERE id_sala = %s AND id_usuario = %s
-        """,
-        (id_sala, id_usuario),
-        one=True,
-    )
-    return fila is not None
+    """Verifica si un usuario es miembro de una sala (cacheado 60s)"""
+    clave = (id_usuario, id_sala)
+    valor = cache_membresia.obtener(clave)
+    if valor is None:
+        fila = consultar_db(
+            """
+            SELECT id FROM Miembros_Sala
+            WHERE id_sala = %s AND id_usuario = %s
+            """,
+            (id_sala, id_usuario),
+            one=True,
+        )
+        valor = fila is not None
+        cache_membresia.guardar(clave, valor)
+    return valor
 
 def archivo_permitido(filename):
     """Verifica si un archivo tiene una extensión permitida"""
-    return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
+    return os.path.splitext(filename)[1][1:].lower() in EXT_TO_TYPE
 
 def insertar_aviso_sala(id_sala, mensaje, fecha):
     """Inserta un mensaje de sistema en la sala (join, leave, etc)"""
@@ -115,6 +239,25 @@ def insertar_aviso_sala(id_sala, mensaje, fecha):
     db.commit()
     cur.close()
 
+def notificar_aviso_sala(id_sala, aviso, fecha):
+    """
+    Tarea de fondo (greenlet): persiste el aviso de sistema y recién después
+    lo emite a la sala, así el handler HTTP responde sin esperar ese commit.
+    Corre en su propio app context para tener conexión a BD propia.
+    """
+    with app.app_context():
+        insertar_aviso_sala(id_sala, aviso, fecha)
+    socketio.emit(
+        "room_notice",
+        {
+            "room_type": "room",
+            "room_id": id_sala,
+            "body": aviso,
+            "timestamp": fecha.isoformat() + "Z",
+        },
+        to=nombre_sala("room", id_sala),
+    )
+
 # ========== RUTAS HTTP ==========
 @app.route("/")
 def index():
@@ -172,6 +315,17 @@ def login():
             flash("Credenciales invalidas.")
             return redirect(url_for("login"))
 
+        # Migración perezosa: si el hash es del formato viejo, re-hashear con bcrypt
+        if es_hash_legado(user["contrasena"]):
+            db = obtener_db()
+            cur = db.cursor()
+            cur.execute(
+                "UPDATE Usuarios SET contrasena = %s WHERE id_usuario = %s",
+                (hashear_contrasena(contrasena), user["id_usuario"]),
+            )
+            db.commit()
+            cur.close()
+
         # Guardar datos en la sesión
         session["user_id"] = user["id_usuario"]
         session["username"] = usuario
@@ -220,39 +374,43 @@ def room_create():
     if not nombre:
         nombre = "Sala sin nombre"
 
-    # Generar código único de 6 dígitos
-    codigo = generar_codigo_sala()
+    # Una sola marca de tiempo para los INSERT y el aviso
+    fecha = datetime.utcnow()
 
     db = obtener_db()
     cur = db.cursor()
-    # Insertar sala en la BD
-    cur.execute(
-        "INSERT INTO Salas (codigo, nombre_sala, id_creador, fecha_creacion) VALUES (%s, %s, %s, %s)",
-        (codigo, nombre, id_usuario, datetime.utcnow()),
-    )
+    # Insertar sala + membresía del creador en una sola transacción con un
+    # único commit (multi=True quedó descartado: el connector lo eliminó en
+    # 9.2 y requirements no lo pinea). El UNIQUE KEY sobre codigo resuelve
+    # las colisiones: si el INSERT choca se reintenta con un código nuevo,
+    # sin SELECT previo (una ida menos a la BD y sin carrera TOCTOU)
+    for _ in range(5):
+        codigo = generar_codigo_sala()
+        try:
+            cur.execute(
+                "INSERT INTO Salas (codigo, nombre_sala, id_creador, fecha_creacion) VALUES (%s, %s, %s, %s)",
+                (codigo, nombre, id_usuario, fecha),
+            )
+            break
+        except IntegrityError:
+            db.rollback()
+    else:
+        cur.close()
+        flash("No se pudo crear la sala, intenta de nuevo.")
+        return redirect(url_for("chat"))
     id_sala = cur.lastrowid
     # Agregar el creador como miembro
     cur.execute(
         "INSERT INTO Miembros_Sala (id_sala, id_usuario, fecha_union) VALUES (%s, %s, %s)",
-        (id_sala, id_usuario, datetime.utcnow()),
+        (id_sala, id_usuario, fecha),
     )
     db.commit()
     cur.close()
+    cache_salas_usuario.invalidar(id_usuario)
 
-    # Notificar a todos en la sala sobre la creación
-    fecha = datetime.utcnow()
+    # Notificar a todos en la sala en segundo plano (el 302 no espera el commit)
     aviso = f"{session.get('username', 'Anon')} se unio a la sala."
-    insertar_aviso_sala(id_sala, aviso, fecha)
-    socketio.emit(
-        "room_notice",
-        {
-            "room_type": "room",
-            "room_id": id_sala,
-            "body": aviso,
-            "timestamp": fecha.isoformat() + "Z",
-        },
-        to=nombre_sala("room", id_sala),
-    )
+    socketio.start_background_task(notificar_aviso_sala, id_sala, aviso, fecha)
 
     flash("Sala creada.")
     return redirect(url_for("chat"))
@@ -265,7 +423,7 @@ def room_join():
     codigo = request.form.get("code", "").strip().upper()
 
     # Validar formato del código
-    if len(codigo) != 6 or not codigo.isdigit():
+    if not CODIGO_RE.match(codigo):
         flash("Codigo invalido.")
         return redirect(url_for("chat"))
 
@@ -289,31 +447,25 @@ def room_join():
         flash("Ya estas en esa sala.")
         return redirect(url_for("chat"))
 
+    # Una sola marca de tiempo para el INSERT y el aviso
+    fecha = datetime.utcnow()
+
     db = obtener_db()
     cur = db.cursor()
     # Insertar como nuevo miembro
     cur.execute(
         "INSERT INTO Miembros_Sala (id_sala, id_usuario, fecha_union) VALUES (%s, %s, %s)",
-        (sala["id_sala"], id_usuario, datetime.utcnow()),
+        (sala["id_sala"], id_usuario, fecha),
     )
     db.commit()
     cur.close()
+    cache_salas_usuario.invalidar(id_usuario)
+    cache_membresia.invalidar((id_usuario, sala["id_sala"]))
 
     flash("Te uniste a la sala.")
-    # Notificar a otros miembros
-    fecha = datetime.utcnow()
+    # Notificar a otros miembros en segundo plano
     aviso = f"{session.get('username', 'Anon')} se unio a la sala."
-    insertar_aviso_sala(sala["id_sala"], aviso, fecha)
-    socketio.emit(
-        "room_notice",
-        {
-            "room_type": "room",
-            "room_id": sala["id_sala"],
-            "body": aviso,
-            "timestamp": fecha.isoformat() + "Z",
-        },
-        to=nombre_sala("room", sala["id_sala"]),
-    )
+    socketio.start_background_task(notificar_aviso_sala, sala["id_sala"], aviso, fecha)
     socketio.emit(
         "actualizar_ui",
         {"motivo": "nueva_sala"},
@@ -328,7 +480,7 @@ def room_delete():
     id_usuario = session["user_id"]
     room_id = request.form.get("room_id", "").strip()
 
-    if not room_id.isdigit():
+    if not ID_RE.match(room_id):
         flash("Sala invalida.")
         return redirect(url_for("chat"))
 
@@ -348,12 +500,22 @@ def room_delete():
         flash("Solo el creador puede borrar la sala.")
         return redirect(url_for("chat"))
 
+    # Obtener los miembros antes del DELETE (el CASCADE borra las filas)
+    # para poder invalidar sus entradas de cache
+    miembros = consultar_db(
+        "SELECT id_usuario FROM Miembros_Sala WHERE id_sala = %s",
+        (room_id,),
+    )
+
     db = obtener_db()
     cur = db.cursor()
     # Eliminar la sala (esto elimina automáticamente sus mensajes y miembros por CASCADE)
     cur.execute("DELETE FROM Salas WHERE id_sala = %s", (room_id,))
     db.commit()
     cur.close()
+    for miembro in miembros:
+        cache_membresia.invalidar((miembro["id_usuario"], room_id))
+        cache_salas_usuario.invalidar(miembro["id_usuario"])
 
     socketio.emit(
         "actualizar_ui",
@@ -370,7 +532,7 @@ def room_leave():
     id_usuario = session["user_id"]
     room_id = request.form.get("room_id", "").strip()
 
-    if not room_id.isdigit():
+    if not ID_RE.match(room_id):
         flash("Sala invalida.")
         return redirect(url_for("chat"))
 
@@ -394,21 +556,13 @@ def room_leave():
     )
     db.commit()
     cur.close()
+    cache_salas_usuario.invalidar(id_usuario)
+    cache_membresia.invalidar((id_usuario, room_id))
 
-    # Notificar a otros miembros
+    # Notificar a otros miembros en segundo plano
     fecha = datetime.utcnow()
     aviso = f"{session.get('username', 'Anon')} salio de la sala."
-    insertar_aviso_sala(room_id, aviso, fecha)
-    socketio.emit(
-        "room_notice",
-        {
-            "room_type": "room",
-            "room_id": room_id,
-            "body": aviso,
-            "timestamp": fecha.isoformat() + "Z",
-        },
-        to=nombre_sala("room", room_id),
-    )
+    socketio.start_background_task(notificar_aviso_sala, room_id, aviso, fecha)
     flash("Saliste de la sala.")
     return redirect(url_for("chat"))
 
@@ -424,80 +578,114 @@ def api_messages():
     room_type = request.args.get("room_type", "")
     room_id = request.args.get("room_id", "")
 
-    if not room_id.isdigit() or room_type != "room":
-        return jsonify([])
+    if room_type != "room" or not ID_RE.match(room_id):
+        return ojsonify([])
 
     room_id = int(room_id)
     # Verificar que el usuario tiene acceso a la sala
     if not usuario_en_sala(id_usuario, room_id):
-        return jsonify([])
+        return ojsonify([])
 
-    # Obtener últimos 50 mensajes (ordenados por ID)
+    # Obtener últimos 50 mensajes; la subconsulta toma los más recientes y
+    # el ORDER BY externo los entrega ya en orden de pantalla, así no hay
+    # que copiar ni invertir las filas en Python
     rows = consultar_db(
         """
-        SELECT m.id_mensaje, m.contenido, m.fecha_envio, m.es_sistema, m.tipo_archivo, u.usuario AS sender
-        FROM Mensajes_Sala m
-        LEFT JOIN Usuarios u ON u.id_usuario = m.id_emisor
-        WHERE m.id_sala = %s
-        ORDER BY m.id_mensaje DESC
-        LIMIT 50
+        SELECT * FROM (
+            SELECT m.id_mensaje, m.contenido, m.fecha_envio, m.es_sistema, m.tipo_archivo, u.usuario AS sender
+            FROM Mensajes_Sala m
+            LEFT JOIN Usuarios u ON u.id_usuario = m.id_emisor
+            WHERE m.id_sala = %s
+            ORDER BY m.id_mensaje DESC
+            LIMIT 50
+        ) t
+        ORDER BY t.id_mensaje ASC
         """,
         (room_id,),
     )
 
-    return jsonify(list(reversed([dict(r) for r in rows])))
+    return ojsonify(rows)
 
 @app.route("/upload-media", methods=["POST"])
 @requiere_login
 def upload_media():
     """
     API para subir archivos multimedia (mp3, mp4, jpg, png).
-    Almacena el archivo en la BD como LONGBLOB.
+    Guarda el archivo en disco (MEDIA_ROOT) y solo la referencia en la BD.
     """
+    # Rechazar por Content-Length antes de parsear el body: un upload
+    # demasiado grande se corta sin asignar ni un chunk
+    if request.content_length and request.content_length > app.config["MAX_CONTENT_LENGTH"]:
+        return ojsonify({"error": "Archivo demasiado grande."}, 413)
+
     id_usuario = session["user_id"]
     room_id = request.form.get("room_id", "").strip()
     
-    if not room_id.isdigit():
-        return jsonify({"error": "Sala invalida."}), 400
+    if not ID_RE.match(room_id):
+        return ojsonify({"error": "Sala invalida."}, 400)
     
     room_id = int(room_id)
     if not usuario_en_sala(id_usuario, room_id):
-        return jsonify({"error": "No eres miembro de esa sala."}), 403
+        return ojsonify({"error": "No eres miembro de esa sala."}, 403)
     
     if "file" not in request.files:
-        return jsonify({"error": "No se subio archivo."}), 400
+        return ojsonify({"error": "No se subio archivo."}, 400)
     
     file = request.files["file"]
     if not file or not archivo_permitido(file.filename):
-        return jsonify({"error": "Archivo no permitido."}), 400
-    
-    # Leer el contenido del archivo en memoria
-    archivo_contenido = file.read()
-    
-    # Detectar tipo
-    ext = file.filename.rsplit(".", 1)[1].lower()
-    if ext == "mp3":
-        file_type = "audio"
-    elif ext == "mp4":
-        file_type = "video"
-    elif ext in {"jpg", "png"}:
-        file_type = "image"
-    else:
-        file_type = "file"
-    
+        return ojsonify({"error": "Archivo no permitido."}, 400)
+
+    # Detectar tipo con la tabla precomputada
+    ext = os.path.splitext(file.filename)[1][1:].lower()
+    file_type = EXT_TO_TYPE.get(ext, "file")
+
+    # Guardar el archivo en disco con nombre direccionado por contenido:
+    # se hashea con SHA256 en chunks de 64 KiB sin cargarlo entero en memoria
+    hasher = hashlib.sha256()
+    fd, ruta_temporal = tempfile.mkstemp(dir=app.config["MEDIA_ROOT"])
+    try:
+        with os.fdopen(fd, "wb") as destino:
+            while True:
+                chunk = file.stream.read(64 * 1024)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+                destino.write(chunk)
+        nombre_archivo = f"{hasher.hexdigest()}.{ext}"
+        os.replace(ruta_temporal, os.path.join(app.config["MEDIA_ROOT"], nombre_archivo))
+    except OSError:
+        os.unlink(ruta_temporal)
+        return ojsonify({"error": "No se pudo guardar el archivo."}, 500)
+
     db = obtener_db()
     cur = db.cursor()
-    
-    # Guardar en BD con el archivo como BLOB
+
+    # Guardar en BD solo la referencia al archivo (no el contenido),
+    # revalidando la membresía en la misma sentencia igual que send_message:
+    # si la sala fue borrada o el usuario salió con el cache aún caliente,
+    # no se inserta nada (el archivo queda en disco: es direccionado por
+    # contenido y puede estar referenciado por otros mensajes)
+    fecha = datetime.utcnow()
     cur.execute(
-        "INSERT INTO Mensajes_Sala (id_sala, id_emisor, contenido, fecha_envio, es_sistema, tipo_archivo, archivo_datos) VALUES (%s, %s, %s, %s, 0, %s, %s)",
-        (room_id, id_usuario, file.filename, datetime.utcnow(), file_type, archivo_contenido),
+        """
+        INSERT INTO Mensajes_Sala (id_sala, id_emisor, contenido, fecha_envio, es_sistema, tipo_archivo)
+        SELECT %s, %s, %s, %s, 0, %s
+        FROM DUAL
+        WHERE EXISTS (
+            SELECT 1 FROM Miembros_Sala WHERE id_sala = %s AND id_usuario = %s
+        )
+        """,
+        (room_id, id_usuario, nombre_archivo, fecha, file_type, room_id, id_usuario),
     )
+    insertado = cur.rowcount
     db.commit()
     id_mensaje = cur.lastrowid
     cur.close()
-    
-    socketio.server.emit(
+    if not insertado:
+        return ojsonify({"error": "No eres miembro de esa sala."}, 403)
+
+    timestamp = fecha.isoformat() + "Z"
+    socketio.emit(
         "media_message",
         {
             "room_type": "room",
@@ -505,39 +693,69 @@ def upload_media():
             "id_mensaje": id_mensaje,
             "type": file_type,
             "sender": session.get("username", "anon"),
-            "timestamp": datetime.utcnow().isoformat() + "Z",
+            "timestamp": timestamp,
         },
-        room=nombre_sala("room", room_id),
-        namespace="/"
+        to=nombre_sala("room", room_id),
     )
     
-    return jsonify({"success": True, "id_mensaje": id_mensaje})
+    return ojsonify({"success": True, "id_mensaje": id_mensaje})
 
 @app.route("/get-media/<int:id_mensaje>")
 def get_media(id_mensaje):
     """
     API para descargar un archivo multimedia.
-    El archivo se envía con el MIME type correcto.
+    El archivo se sirve desde disco (soporta Range para video) con el MIME
+    type correcto; los mensajes viejos con BLOB en la BD siguen funcionando.
     """
+    # Consultar primero los metadatos solos: el BLOB de los mensajes viejos
+    # recién se trae si de verdad hay que mandar los bytes
     mensaje = consultar_db(
-        "SELECT archivo_datos, tipo_archivo, contenido FROM Mensajes_Sala WHERE id_mensaje = %s",
+        "SELECT tipo_archivo, contenido, archivo_datos IS NOT NULL AS tiene_blob FROM Mensajes_Sala WHERE id_mensaje = %s",
         (id_mensaje,),
         one=True,
     )
-    
-    if not mensaje or not mensaje["archivo_datos"]:
+
+    if not mensaje or not mensaje["tipo_archivo"]:
         return "Not found", 404
-    
-    # Detectar el MIME type según el tipo de archivo
-    mime_types = {
-        "audio": "audio/mpeg",
-        "video": "video/mp4",
-        "image": "image/jpeg" if mensaje["contenido"].lower().endswith(".jpeg") or mensaje["contenido"].lower().endswith(".jpg") else "image/png",
-    }
-    mime_type = mime_types.get(mensaje["tipo_archivo"], "application/octet-stream")
-    
-    from flask import Response
-    return Response(mensaje["archivo_datos"], mimetype=mime_type)
+
+    # Detectar el MIME type según la extensión del archivo guardado
+    ext = os.path.splitext(mensaje["contenido"])[1][1:].lower()
+    mime_type = MIME_POR_EXTENSION.get(ext, "application/octet-stream")
+
+    # Un mensaje nunca cambia de archivo: cachear agresivo para que los
+    # re-render del cliente (y un CDN) no vuelvan a pedir los bytes
+    cache_control = "public, max-age=31536000, immutable"
+
+    # Mensajes viejos: el archivo todavía vive en la BD como BLOB
+    if mensaje["tiene_blob"]:
+        etag = f"msg-{id_mensaje}"
+        # Revalidación por ETag antes de tocar el BLOB: el 304 responde
+        # sin traer los bytes desde MySQL
+        if etag in request.if_none_match:
+            respuesta = Response(status=304)
+            respuesta.headers["Cache-Control"] = cache_control
+            respuesta.set_etag(etag)
+            return respuesta
+        blob = consultar_db(
+            "SELECT archivo_datos FROM Mensajes_Sala WHERE id_mensaje = %s",
+            (id_mensaje,),
+            one=True,
+        )
+        respuesta = Response(blob["archivo_datos"], mimetype=mime_type)
+        respuesta.headers["Cache-Control"] = cache_control
+        respuesta.set_etag(etag)
+        return respuesta.make_conditional(request)
+
+    # Mensajes nuevos: contenido es el nombre del archivo en MEDIA_ROOT;
+    # conditional=True habilita Range / If-Modified-Since / ETag y sendfile(2)
+    respuesta = send_from_directory(
+        app.config["MEDIA_ROOT"],
+        mensaje["contenido"],
+        mimetype=mime_type,
+        conditional=True,
+    )
+    respuesta.headers["Cache-Control"] = cache_control
+    return respuesta
 
 # ========== SOCKET IO (WEBSOCKETS PARA TIEMPO REAL) ==========
 @socketio.on("connect")
@@ -550,13 +768,18 @@ def manejar_conexion():
     # Unirse a la "sala" personal del usuario para notificaciones
     join_room(nombre_sala_usuario(id_usuario))
 
-    # Unirse a todas las salas a las que pertenece
-    salas = consultar_db(
-        "SELECT id_sala FROM Miembros_Sala WHERE id_usuario = %s",
-        (id_usuario,),
-    )
-    for sala in salas:
-        join_room(nombre_sala("room", sala["id_sala"]))
+    # Unirse a todas las salas a las que pertenece (lista cacheada con TTL
+    # corto para no repetir el SELECT en cada reconexión)
+    rooms = cache_salas_usuario.obtener(id_usuario)
+    if rooms is None:
+        salas = consultar_db(
+            "SELECT id_sala FROM Miembros_Sala WHERE id_usuario = %s",
+            (id_usuario,),
+        )
+        rooms = [nombre_sala("room", sala["id_sala"]) for sala in salas]
+        cache_salas_usuario.guardar(id_usuario, rooms)
+    for room in rooms:
+        join_room(room)
 
 @socketio.on("send_message")
 def manejar_envio_mensaje(data):
@@ -573,24 +796,36 @@ def manejar_envio_mensaje(data):
     body = (data.get("body") or "").strip()
 
     # Validaciones
-    if room_type != "room" or not str(room_id).isdigit() or not body:
+    if room_type != "room" or not ID_RE.match(str(room_id)) or not body:
         return
 
     room_id = int(room_id)
-    # Verificar que el usuario es miembro
+    # Verificar que el usuario es miembro (cache, sin ida a la BD en caliente)
     if not usuario_en_sala(id_usuario, room_id):
         return
 
-    # Guardar en BD
+    # Guardar en BD validando la membresía en la misma sentencia: una sola
+    # ida en lugar de SELECT + INSERT; si el cache estaba viejo y el usuario
+    # ya no es miembro, no se inserta nada y tampoco se emite
     db = obtener_db()
     cur = db.cursor()
     fecha = datetime.utcnow()
     cur.execute(
-        "INSERT INTO Mensajes_Sala (id_sala, id_emisor, contenido, fecha_envio, es_sistema) VALUES (%s, %s, %s, %s, 0)",
-        (room_id, id_usuario, body, fecha),
+        """
+        INSERT INTO Mensajes_Sala (id_sala, id_emisor, contenido, fecha_envio, es_sistema)
+        SELECT %s, %s, %s, %s, 0
+        FROM DUAL
+        WHERE EXISTS (
+            SELECT 1 FROM Miembros_Sala WHERE id_sala = %s AND id_usuario = %s
+        )
+        """,
+        (room_id, id_usuario, body, fecha, room_id, id_usuario),
     )
+    insertado = cur.rowcount
     db.commit()
     cur.close()
+    if not insertado:
+        return
 
     # Emitir a todos en la sala
     emit(
@@ -607,5 +842,12 @@ def manejar_envio_mensaje(data):
 
 # ========== PUNTO DE ENTRADA ==========
 if __name__ == "__main__":
-    # Inicia el servidor Flask con SocketIO en puerto 5000
-    socketio.run(app, host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
+    # Servidor de desarrollo; en producción usar gunicorn con el worker
+    # de gevent-websocket. Debug solo si se pide explícitamente por entorno.
+    socketio.run(
+        app,
+        host="0.0.0.0",
+        port=5000,
+        debug=os.environ.get("FLASK_DEBUG") == "1",
+        use_reloader=False,
+    )
\ No newline at end of file
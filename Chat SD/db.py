@@ -1,45 +1,77 @@
-"""
-Módulo de conexión a la base de datos MySQL
-Proporciona funciones para ejecutar queries y conexiones seguras
-"""
-import os
-import mysql.connector
-from flask import g
-
-def obtener_db():
-    """
-    Obtiene la conexión a la base de datos.
-    La conexión se almacena en el contexto de Flask (g) para reutilizarse.
-    """
-    if "db" not in g:
-        g.db = mysql.connector.connect(
-            host=os.environ.get("MYSQL_HOST", "localhost"),
-            user=os.environ.get("MYSQL_USER", "root"),
-            password=os.environ.get("MYSQL_PASSWORD", ""),
-            database=os.environ.get("MYSQL_DB", "chat"),
-            charset="utf8mb4",
-            collation="utf8mb4_unicode_ci",
-            autocommit=False,
-        )
-    return g.db
-
-def cerrar_db(e=None):
-    """Cierra la conexión a la base de datos al terminar la solicitud"""
-    db = g.pop("db", None)
-    if db:
-        db.close()
-
-def consultar_db(query, args=(), one=False):
-    """
-    Ejecuta una query a la base de datos
-    @param query: Comando SQL con placeholders %s
-    @param args: Tuple con parámetros para la query
-    @param one: Si es True, retorna solo una fila. Si es False, retorna lista
-    @return: Un diccionario (one=True) o lista de diccionarios
-    """
-    db = obtener_db()
-    cursor = db.cursor(dictionary=True)
-    cursor.execute(query, args)
-    filas = cursor.fetchall()
-    cursor.close()
-    return (filas[0] if filas else None) if one else filas
\ No newline at end of file
+"""
+Módulo de conexión a la base de datos MySQL
+Proporciona funciones para ejecutar queries y conexiones seguras
+"""
+import os
+import time
+import mysql.connector
+import mysql.connector.pooling
+from mysql.connector.errors import PoolError
+from flask import g
+
+# Pool de conexiones: amortiza el handshake TCP + auth de MySQL entre miles
+# de requests. Se crea perezosamente en el primer uso para que importar el
+# módulo no requiera una BD accesible.
+_pool = None
+
+def _obtener_pool():
+    global _pool
+    if _pool is None:
+        _pool = mysql.connector.pooling.MySQLConnectionPool(
+            pool_name="chat",
+            pool_size=int(os.environ.get("DB_POOL", "10")),
+            pool_reset_session=True,
+            host=os.environ.get("MYSQL_HOST", "localhost"),
+            user=os.environ.get("MYSQL_USER", "root"),
+            password=os.environ.get("MYSQL_PASSWORD", ""),
+            database=os.environ.get("MYSQL_DB", "chat"),
+            charset="utf8mb4",
+            collation="utf8mb4_unicode_ci",
+            autocommit=False,
+        )
+    return _pool
+
+def _conexion_del_pool(intentos=50, espera=0.1):
+    """
+    Saca una conexión del pool esperando si está agotado.
+    get_connection() no bloquea: con el pool vacío lanza PoolError de
+    inmediato, así que bajo ráfagas de greenlets se reintenta con una
+    espera corta (cooperativa bajo gevent) hasta ~5s antes de rendirse.
+    """
+    pool = _obtener_pool()
+    for _ in range(intentos - 1):
+        try:
+            return pool.get_connection()
+        except PoolError:
+            time.sleep(espera)
+    return pool.get_connection()
+
+def obtener_db():
+    """
+    Obtiene una conexión del pool.
+    La conexión se almacena en el contexto de Flask (g) para reutilizarse.
+    """
+    if "db" not in g:
+        g.db = _conexion_del_pool()
+    return g.db
+
+def cerrar_db(e=None):
+    """Devuelve la conexión al pool al terminar la solicitud"""
+    db = g.pop("db", None)
+    if db:
+        db.close()
+
+def consultar_db(query, args=(), one=False):
+    """
+    Ejecuta una query a la base de datos
+    @param query: Comando SQL con placeholders %s
+    @param args: Tuple con parámetros para la query
+    @param one: Si es True, retorna solo una fila. Si es False, retorna lista
+    @return: Un diccionario (one=True) o lista de diccionarios
+    """
+    db = obtener_db()
+    cursor = db.cursor(dictionary=True)
+    cursor.execute(query, args)
+    filas = cursor.fetchall()
+    cursor.close()
+    return (filas[0] if filas else None) if one else filas
@@ -0,0 +1,21 @@
+-- Cambios de esquema aplicados sobre la BD `chat` existente.
+-- Ejecutar en orden; cada bloque es idempotente si no se repitió.
+
+-- Código de sala único y de ancho fijo: CHAR(6) binario hace que la
+-- búsqueda por índice sea un memcmp, y el UNIQUE KEY permite que
+-- room_create inserte directo y reintente en caso de colisión.
+ALTER TABLE Salas
+    MODIFY codigo CHAR(6) CHARACTER SET utf8mb4 COLLATE utf8mb4_bin NOT NULL,
+    ADD UNIQUE KEY uk_codigo (codigo);
+
+-- Membresías: uk_user_sala resuelve usuario_en_sala con una búsqueda
+-- cubierta (sin leer la fila) y de paso impide membresías duplicadas;
+-- k_sala_user sirve los JOIN por sala (lista de salas del chat).
+ALTER TABLE Miembros_Sala
+    ADD UNIQUE KEY uk_user_sala (id_usuario, id_sala),
+    ADD KEY k_sala_user (id_sala, id_usuario);
+
+-- Historial: el ORDER BY id_mensaje DESC LIMIT 50 de /api/messages se
+-- vuelve un range scan inverso sobre el índice, sin filesort.
+ALTER TABLE Mensajes_Sala
+    ADD KEY k_sala_msg (id_sala, id_mensaje DESC);
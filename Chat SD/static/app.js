@@ -1,5 +1,8 @@
 // ========== INICIALIZACIÓN Y VARIABLES GLOBALES ==========
-const socket = io(); // Conexión WebSocket para mensajes en tiempo real
+// Conexión para mensajes en tiempo real. Solo websocket: evita la
+// negociación inicial por long-polling (un RTT menos al conectar) y el
+// costo de una petición HTTP completa por heartbeat del fallback.
+const socket = io({ transports: ["websocket"] });
 let salaActual = null; // Almacena la sala seleccionada actualmente
 
 // Elementos del DOM